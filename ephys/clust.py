@@ -3,12 +3,20 @@ from __future__ import print_function
 import os
 import glob
 import numpy as np
-from scipy.interpolate import UnivariateSpline
 from .core import file_finder, load_probe, load_fs, load_clusters, load_spikes
-from .core import find_info, find_kwd, find_kwik, find_kwx
-import h5py as h5
+from .core import find_info, find_kwd, find_kwik, find_kwx, open_h5, lru_cache
 import json
-from six.moves import range
+from six.moves import range, zip
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# number of spikes gathered together by compute_cluster_waveforms_fast
+WAVEFORM_SPIKE_BLOCK = 4096
+# spikes closer together than this many samples are read with a single slice
+WAVEFORM_READ_GAP = 1024
 
 
 @file_finder
@@ -69,6 +77,25 @@ def find_mean_masks(block_path, cluster, cluster_store=0, clustering='main'):
                         )
 
 
+@lru_cache(maxsize=4096)
+def _read_float32_file(path, mtime):
+    '''
+    Reads a flat float32 file from the cluster store. Results are cached by
+        path and modification time, so they are returned read-only.
+    '''
+    arr = np.fromfile(path, dtype=np.float32)
+    arr.flags.writeable = False
+    return arr
+
+
+def _read_mean_masks(path):
+    return _read_float32_file(path, os.path.getmtime(path))
+
+
+def _read_mean_waveforms(path, nchan):
+    return _read_float32_file(path, os.path.getmtime(path)).reshape((-1, nchan))
+
+
 def mean_masks_w(block_path, cluster):
     '''
     Weights are equivalent to the mean_mask values for the channel.
@@ -84,9 +111,8 @@ def mean_masks_w(block_path, cluster):
     ------
     w : weight vector
     '''
-    mean_masks = find_mean_masks(block_path, cluster)
-    mean_masks_arr = np.fromfile(mean_masks, dtype=np.float32)
-    return mean_masks_arr
+    # copy, since the cached array is shared between calls
+    return _read_mean_masks(find_mean_masks(block_path, cluster)).copy()
 
 
 def max_masks_w(block_path, cluster):
@@ -107,7 +133,7 @@ def max_masks_w(block_path, cluster):
     ------
     w : weight vector
     '''
-    w = mean_masks_w(block_path, cluster)
+    w = _read_mean_masks(find_mean_masks(block_path, cluster))
     return w == w.max()
 
 
@@ -131,7 +157,7 @@ def get_cluster_coords(block_path, cluster, weight_func=None):
     xy : numpy array of coordinates
     '''
     if weight_func is None:
-        weight_func = max_masks_w
+        return get_cluster_coords_fast(block_path, cluster)
     w = weight_func(block_path, cluster)
 
     prb_info = load_probe(block_path)
@@ -142,11 +168,41 @@ def get_cluster_coords(block_path, cluster, weight_func=None):
     return np.dot(w, coords) / w.sum()
 
 
+def get_cluster_coords_fast(block_path, cluster):
+    '''
+    Returns the location of a given cluster on the probe as the mean of the
+        coordinates of the channel(s) with the largest mean mask value.
+
+    This is get_cluster_coords with the default max_masks_w weights, without
+        building the full weight vector and coordinate array.
+
+    Parameters
+    ------
+    block_path : str
+        the path to the block
+    cluster : int
+        the cluster identifier
+
+    Returns
+    ------
+    xy : numpy array of coordinates
+    '''
+    w = _read_mean_masks(find_mean_masks(block_path, cluster))
+    max_chans = np.flatnonzero(w == w.max())
+
+    prb_info = load_probe(block_path)
+    channels = prb_info.channel_groups[0]['channels']
+    geometry = prb_info.channel_groups[0]['geometry']
+
+    return np.array([geometry[channels[ind]] for ind in max_chans], dtype=float).mean(axis=0)
+
+
 # spike shapes
 
 def upsample_spike(spike_shape, fs, new_fs=1000000.0):
     '''
-    upsamples a spike shape to prepare it for computing the spike width
+    upsamples a spike shape by linear interpolation to prepare it for
+        computing the spike width
 
     Parameters
     ------
@@ -164,11 +220,9 @@ def upsample_spike(spike_shape, fs, new_fs=1000000.0):
     new_spike_shape :
         upsampled spike shape
     '''
-    t_max = spike_shape.shape[0] / fs
-    t = np.arange(0, t_max, 1 / fs)[:spike_shape.shape[0]]
-    spl = UnivariateSpline(t, spike_shape)
-    ts = np.arange(0, t_max, 1 / new_fs)
-    return ts, spl(ts)
+    t = np.arange(spike_shape.shape[0]) / fs
+    ts = np.arange(0, spike_shape.shape[0] / fs, 1 / new_fs)
+    return ts, np.interp(ts, t, spike_shape)
 
 
 def get_troughpeak(time, spike_shape):
@@ -180,17 +234,18 @@ def get_troughpeak(time, spike_shape):
     time : numpy array
         time series of spike data
     spike_shape : numpy array
-        the spike shape
+        the spike shape. if 2-dimensional, each row is a spike shape
 
     Returns
     ------
-    trough_time : float
+    trough_time : float or numpy array
         time of trough in seconds
-    peak_time : float
+    peak_time : float or numpy array
         time of peak in seconds
     '''
-    trough_i = spike_shape.argmin()
-    peak_i = spike_shape[trough_i:].argmax() + trough_i
+    trough_i = spike_shape.argmin(axis=-1)
+    after_trough = np.arange(spike_shape.shape[-1]) >= np.expand_dims(trough_i, -1)
+    peak_i = np.where(after_trough, spike_shape, -np.inf).argmax(axis=-1)
     return time[trough_i], time[peak_i]
 
 
@@ -209,31 +264,18 @@ def get_width_half_height(time,spike_shape):
         time between crossings in seconds
 
     '''
-    width = np.nan;
-    
-    trough,peak = get_troughpeak(time,spike_shape)
-    ind = np.where(time == trough)
-    troughind = ind[0][0]
-    
-    spike_shape /= -spike_shape.min()
-    spike_shape = spike_shape + 0.5
-    zero_crossings = np.where(np.diff(np.sign(spike_shape)))[0]
-    
-    i = zero_crossings < troughind
-    j = zero_crossings > troughind
+    troughind = spike_shape.argmin()
 
-    if (True in i) & (True in j):
-        # zero crossings before trough
-        i = (np.where(i))
-        pre_ind = zero_crossings[max(i[0])]
-        
-        # zero crossings after trough
-        j = (np.where(j))
-        post_ind = zero_crossings[min(j[0])]
-        
-        width = time[post_ind] - time[pre_ind]
+    shape = spike_shape / -spike_shape[troughind] + 0.5
+    zero_crossings = np.flatnonzero(np.diff(np.signbit(shape).view(np.int8)))
 
-    return width
+    # last crossing before the trough and first crossing after it
+    pre = np.searchsorted(zero_crossings, troughind, side='left')
+    post = np.searchsorted(zero_crossings, troughind, side='right')
+    if pre == 0 or post == len(zero_crossings):
+        return np.nan
+
+    return time[zero_crossings[post]] - time[zero_crossings[pre - 1]]
 
 
 def get_width(block_path, cluster, new_fs=1000000.0):
@@ -257,12 +299,47 @@ def get_width(block_path, cluster, new_fs=1000000.0):
     fs = load_fs(block_path)
     exemplar = get_spike_exemplar(block_path, cluster)
 
-    trough, peak = get_troughpeak(*upsample_spike(exemplar, fs, new_fs=new_fs))
-
+    return _get_widths(exemplar[np.newaxis, :], fs, new_fs)[0]
+
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _spike_width_numba(spike_shape, fs, new_fs):
+        '''
+        trough to peak width of one spike shape, linearly upsampled to new_fs.
+            The trough and peak are found in a single scan each.
+        '''
+        n_samples = spike_shape.shape[0]
+        ts = np.arange(0, n_samples / fs, 1 / new_fs)
+        upsampled = np.interp(ts, np.arange(n_samples) / fs, spike_shape)
+        trough_i = 0
+        for i in range(1, upsampled.shape[0]):
+            if upsampled[i] < upsampled[trough_i]:
+                trough_i = i
+        peak_i = trough_i
+        for i in range(trough_i + 1, upsampled.shape[0]):
+            if upsampled[i] > upsampled[peak_i]:
+                peak_i = i
+        return ts[peak_i] - ts[trough_i]
+else:
+    _spike_width_numba = None
+
+
+def _get_widths(exemplars, fs, new_fs):
+    '''
+    trough to peak widths of spike shapes (one per row), linearly upsampled
+        to new_fs
+    '''
+    if _spike_width_numba is not None:
+        return np.array([_spike_width_numba(np.asarray(exemplar, dtype=np.float64), fs, new_fs)
+                         for exemplar in exemplars])
+    upsampled = [upsample_spike(exemplar, fs, new_fs=new_fs) for exemplar in exemplars]
+    ts = upsampled[0][0]
+    trough, peak = get_troughpeak(ts, np.array([shape for _, shape in upsampled]))
     return peak - trough
 
 
-def get_mean_waveform_array(block_path, cluster):
+def get_mean_waveform_array(block_path, cluster, prb_info=None):
     '''
     returns the mean spike shape on all channels
 
@@ -272,19 +349,22 @@ def get_mean_waveform_array(block_path, cluster):
         the path to the block
     cluster : int
         the cluster identifier
+    prb_info : probe info, optional
+        probe info from load_probe. default: load it from block_path
 
     Returns
     ------
     mean_waveform_array : numpy array
         mean waveform on principal channel. shape: (time_samples,channels)
     '''
-    prb_info = load_probe(block_path)
+    if prb_info is None:
+        prb_info = load_probe(block_path)
     mean_waveform = find_mean_waveforms(block_path, cluster)
-    shape = (-1, len(prb_info.channel_groups[0]['channels']))
-    return np.fromfile(mean_waveform, dtype=np.float32).reshape(shape)
+    # copy, since the cached array is shared between calls
+    return _read_mean_waveforms(mean_waveform, len(prb_info.channel_groups[0]['channels'])).copy()
 
 
-def get_spike_exemplar(block_path, cluster):
+def get_spike_exemplar(block_path, cluster, prb_info=None):
     '''
     Returns an exemplar of the spike shape on the principal channel
 
@@ -294,6 +374,8 @@ def get_spike_exemplar(block_path, cluster):
         the path to the block
     cluster : int
         the cluster identifier
+    prb_info : probe info, optional
+        probe info from load_probe. default: load it from block_path
 
     Returns
     ------
@@ -301,13 +383,16 @@ def get_spike_exemplar(block_path, cluster):
         mean waveform on principal channel
     '''
 
-    mean_waveform = find_mean_waveforms(block_path, cluster)
-    arr = get_mean_waveform_array(block_path, cluster)
+    if prb_info is None:
+        prb_info = load_probe(block_path)
+    nchan = len(prb_info.channel_groups[0]['channels'])
 
-    mean_masks = find_mean_masks(block_path, cluster)
-    mean_masks_arr = np.fromfile(mean_masks, dtype=np.float32)
+    # find the principal channel from the (small) mean masks first, so that
+    # only that channel of the mean waveforms needs to be paged in
+    chan = _read_mean_masks(find_mean_masks(block_path, cluster)).argmax()
+    arr = np.memmap(find_mean_waveforms(block_path, cluster), dtype=np.float32, mode='r')
 
-    return arr[:, mean_masks_arr.argmax()]
+    return np.ascontiguousarray(arr.reshape((-1, nchan))[:, chan])
 
 
 def get_wide_narrow(block_path, cluster_list, thresh):
@@ -330,8 +415,15 @@ def get_wide_narrow(block_path, cluster_list, thresh):
     '''
     wide = []
     narrow = []
-    for cluster in cluster_list:
-        sw = get_width(block_path, cluster)
+    if len(cluster_list) == 0:
+        return (wide, narrow)
+
+    fs = load_fs(block_path)
+    prb_info = load_probe(block_path)
+    exemplars = np.array([get_spike_exemplar(block_path, cluster, prb_info=prb_info)
+                          for cluster in cluster_list])
+    widths = _get_widths(exemplars, fs, 1000000.0)
+    for cluster, sw in zip(cluster_list, widths):
         if sw >= thresh:
             wide.append(cluster)
         else:
@@ -383,12 +475,39 @@ def spikeindices(block_path, cluster, channel_group=0, clustering='main'):
     indices : numpy array
         indices of spikes in a specified cluster
     '''
-    with h5.File(find_kwik(block_path), 'r') as kwikf:
+    with open_h5(find_kwik(block_path)) as kwikf:
         sptimes = kwikf[
             '/channel_groups/{}/spikes/clusters/{}'.format(channel_group, clustering)][:]
     return (sptimes == cluster)
 
 
+def spikeindices_all(block_path, channel_group=0, clustering='main'):
+    '''
+    Return the indices of spikes for every cluster, reading the clustering once
+
+    Parameters
+    ------
+    block_path : str
+        the path to the block
+    channel_group :
+        the channel group identifier
+    clustering : str, optional
+        ID of clustering
+
+    Returns
+    ------
+    indices : dict
+        maps each cluster identifier to a sorted numpy array of the indices
+        of its spikes
+    '''
+    with open_h5(find_kwik(block_path)) as kwikf:
+        spike_clusters = kwikf[
+            '/channel_groups/{}/spikes/clusters/{}'.format(channel_group, clustering)][:]
+    order = np.argsort(spike_clusters, kind='mergesort')
+    clusters, splits = np.unique(spike_clusters[order], return_index=True)
+    return dict(zip(clusters, np.split(order, splits[1:])))
+
+
 def compute_cluster_waveforms(block_path):
     '''
     legacy method for computing cluster waveforms
@@ -405,31 +524,48 @@ def compute_cluster_waveforms(block_path):
         nchans = info['params']['nchan']
     spikes = load_spikes(block_path)
     clusters = spikes['cluster'].unique()
+    cluster_indices = spikeindices_all(block_path)
     phy_fold = make_phy_folder(block_path)
-
-    for cluster in clusters:
-        print("Cluster: {}".format(cluster))
-        cluspikes = spikes[spikes['cluster'] == cluster]
-        cluspiketimes = cluspikes['time_samples'].values
-        mean_waveform = np.zeros((prespike + postspike, nchans))
-
-        waveforms = np.zeros((len(cluspiketimes), prespike + postspike, nchans))
-        with h5.File(find_kwd(block_path), 'r') as kwdf:
-            for ind, sptime in enumerate(cluspiketimes):
-                test = np.zeros((prespike + postspike, nchans))
-                start_ind = max((int(sptime - prespike)), 0)
-                start_ind2 = abs(min(int(sptime - prespike), 0))
-                test[start_ind2:] = kwdf['/recordings/0/data'][start_ind:int(sptime + postspike), :]
-                waveforms[ind, :, :] = test
-                mean_waveform += test
-
-        waveforms = waveforms.flatten()
-        mean_waveform /= len(cluspiketimes)
-        mean_waveform = mean_waveform.flatten()
-        with h5.File(find_kwx(block_path), 'r') as kwxf:
-
-            cluster_spike_inds = spikeindices(block_path, cluster)
-            nspike = np.count_nonzero(cluster_spike_inds)
+    wave_length = prespike + postspike
+
+    # the cluster of each spike and its position among that cluster's spikes
+    cluster_map = {cluster: idx for idx, cluster in enumerate(clusters)}
+    spike_clusters = spikes['cluster'].map(cluster_map).values
+    spike_positions = spikes.groupby('cluster').cumcount().values
+    counts = np.bincount(spike_clusters, minlength=len(clusters))
+
+    # each cluster's .waveforms file is sized up front and filled in place
+    # as the windows are read, opening it only for each write
+    mean_waveforms = np.zeros((len(clusters), wave_length, nchans))
+    row_bytes = wave_length * nchans * np.dtype(np.float64).itemsize
+    waveform_paths = [os.path.join(phy_fold, '{}.waveforms'.format(cluster))
+                      for cluster in clusters]
+    for path, count in zip(waveform_paths, counts):
+        with open(path, 'wb') as f:
+            f.truncate(count * row_bytes)
+
+    # walk the spikes of all clusters in time order, so the recording is read
+    # in a single sequential pass
+    order = np.argsort(spikes['time_samples'].values, kind='mergesort')
+    starts = spikes['time_samples'].values[order].astype(np.int64) - prespike
+    with open_h5(find_kwd(block_path)) as kwdf:
+        for run, windows in _iter_spike_windows(kwdf['/recordings/0/data'], starts, wave_length):
+            run_spikes = order[run]
+            perm, run_clusters, first, last = _split_by_cluster(spike_clusters[run_spikes])
+            run_spikes = run_spikes[perm]
+            windows = windows[perm].astype(np.float64)
+            for idx, lo, hi in zip(run_clusters, first, last):
+                mean_waveforms[idx] += windows[lo:hi].sum(axis=0)
+                _write_waveform_rows(waveform_paths[idx], spike_positions[run_spikes[lo:hi]],
+                                     windows[lo:hi], row_bytes)
+
+    with open_h5(find_kwx(block_path)) as kwxf:
+        for idx, cluster in enumerate(clusters):
+            print("Cluster: {}".format(cluster))
+            mean_waveform = (mean_waveforms[idx] / counts[idx]).flatten()
+
+            cluster_spike_inds = cluster_indices[cluster]
+            nspike = len(cluster_spike_inds)
             masks = kwxf['/channel_groups/0/features_masks'][cluster_spike_inds, :, 1]
             masks = np.reshape(masks, (nspike, nchans, -1))
             masks = np.mean(masks, axis=2)
@@ -439,14 +575,58 @@ def compute_cluster_waveforms(block_path):
             features = features.flatten()
             masks = masks.flatten()
 
-            # make phy folder
+            mean_waveform.tofile(os.path.join(phy_fold, '{}.mean_waveforms'.format(cluster)))
+            masks.tofile(os.path.join(phy_fold, '{}.masks'.format(cluster)))
+            mean_masks.tofile(os.path.join(phy_fold, '{}.mean_masks'.format(cluster)))
+            mean_features.tofile(os.path.join(phy_fold, '{}.mean_features'.format(cluster)))
+            features.tofile(os.path.join(phy_fold, '{}.features'.format(cluster)))
+
+
+def _iter_spike_windows(recording_data, starts, wave_length):
+    '''
+    Reads the windows of wave_length samples beginning at each of the sorted
+    starts. Runs of nearby spikes are read from the dataset with one slice so
+    that only the samples around spikes are loaded into memory. Samples
+    outside of the recording are zero.
+
+    Yields the indices into starts of each run and its (spikes, wave_length,
+    channels) windows.
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    offsets = np.arange(wave_length)
+    n_samples = recording_data.shape[0]
+    for block_start in range(0, len(starts), WAVEFORM_SPIKE_BLOCK):
+        block = np.arange(block_start, min(block_start + WAVEFORM_SPIKE_BLOCK, len(starts)))
+        breaks = np.flatnonzero(np.diff(starts[block]) > WAVEFORM_READ_GAP) + 1
+        for run in np.split(block, breaks):
+            lo, hi = starts[run[0]], starts[run[-1]] + wave_length
+            data = recording_data[max(lo, 0):min(hi, n_samples), :]
+            if lo < 0 or hi > n_samples:
+                data = np.pad(data, ((max(-lo, 0), max(hi - n_samples, 0)), (0, 0)), 'constant')
+            yield run, data[(starts[run] - lo)[:, np.newaxis] + offsets[np.newaxis, :]]
 
-        waveforms.tofile(os.path.join(phy_fold, '{}.waveforms'.format(cluster)))
-        mean_waveform.tofile(os.path.join(phy_fold, '{}.mean_waveforms'.format(cluster)))
-        masks.tofile(os.path.join(phy_fold, '{}.masks'.format(cluster)))
-        mean_masks.tofile(os.path.join(phy_fold, '{}.mean_masks'.format(cluster)))
-        mean_features.tofile(os.path.join(phy_fold, '{}.mean_features'.format(cluster)))
-        features.tofile(os.path.join(phy_fold, '{}.features'.format(cluster)))
+
+def _split_by_cluster(spike_clusters):
+    '''
+    Returns the stable order that groups spike_clusters by cluster, along with
+    the cluster index and the [first, last) bounds of each group in that order.
+    '''
+    perm = np.argsort(spike_clusters, kind='mergesort')
+    clusters, first = np.unique(spike_clusters[perm], return_index=True)
+    last = np.append(first[1:], len(perm))
+    return perm, clusters, first, last
+
+
+def _write_waveform_rows(path, positions, rows, row_bytes):
+    '''
+    Writes float64 rows into a .waveforms file at the given row positions,
+    with one write per run of consecutive positions.
+    '''
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    with open(path, 'r+b') as f:
+        for lo, hi in zip(np.concatenate([[0], breaks]), np.append(breaks, len(positions))):
+            f.seek(positions[lo] * row_bytes)
+            f.write(np.ascontiguousarray(rows[lo:hi]).tobytes())
 
 
 def compute_cluster_waveforms_fast(block_path, spikes, before=10, after=30, n_chans=-1):
@@ -477,7 +657,7 @@ def compute_cluster_waveforms_fast(block_path, spikes, before=10, after=30, n_ch
     wave_length = before + 1 + after
 
     kwd = find_kwd(block_path)
-    with h5.File(kwd, 'r') as kwd_f:
+    with open_h5(kwd) as kwd_f:
         if n_chans == -1:
             recordings = np.sort(
                 np.array(list(kwd_f['recordings'].keys()), dtype=int)).astype('unicode')
@@ -487,22 +667,35 @@ def compute_cluster_waveforms_fast(block_path, spikes, before=10, after=30, n_ch
 
         num_clusters = len(spikes['cluster'].unique())
         counts = np.zeros(num_clusters)
-        waveforms = np.zeros((num_clusters, wave_length, n_chans))
+        # accumulate channel-major so that each channel's samples are contiguous
+        waveforms = np.zeros((num_clusters, n_chans, wave_length))
         cluster_map = spikes['cluster'].unique()
         cluster_map.sort()
         cluster_map = {cluster: idx for idx, cluster in enumerate(cluster_map)}
 
-        for recording, recording_group in spikes.groupby('recording'):
-            recording_data = kwd_f['recordings'][str(recording)]['data'][:, :]
-            for cluster, cluster_spikes in recording_group.groupby('cluster'):
-                starts = cluster_spikes['time_samples'].values - before
-                starts = starts[starts > 0]
-                starts = starts[starts + wave_length < recording_data.shape[0]]
-                counts[cluster_map[cluster]] += len(starts)
-
-                for i in range(wave_length):
-                    waveforms[cluster_map[cluster], i,
-                              :] += np.sum(recording_data[starts + i, :], axis=0)
+        # sort by (recording, time) so that each recording is read in a single
+        # pass over all clusters, carrying the cluster index of every spike
+        order = np.lexsort((spikes['time_samples'].values, spikes['recording'].values))
+        rec_arr = spikes['recording'].values[order]
+        clu_arr = spikes['cluster'].map(cluster_map).values[order]
+        t_arr = spikes['time_samples'].values[order].astype(np.int64)
+        breaks = np.flatnonzero(np.diff(rec_arr) != 0) + 1
+        bounds = np.concatenate([[0], breaks, [len(order)]])
+
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            recording_data = kwd_f['recordings'][str(rec_arr[lo])]['data']
+            starts = t_arr[lo:hi] - before
+            keep = (starts > 0) & (starts + wave_length < recording_data.shape[0])
+            starts = starts[keep]
+            spike_clusters = clu_arr[lo:hi][keep]
+            counts += np.bincount(spike_clusters, minlength=num_clusters)
+
+            for run, windows in _iter_spike_windows(recording_data, starts, wave_length):
+                # sort the run's windows by cluster and sum each cluster's slice
+                perm, run_clusters, first, last = _split_by_cluster(spike_clusters[run])
+                windows = windows[perm]
+                for cluster_idx, lo_w, hi_w in zip(run_clusters, first, last):
+                    waveforms[cluster_idx] += windows[lo_w:hi_w].sum(axis=0, dtype=np.float64).T
 
     waveforms /= counts.reshape((num_clusters, 1, 1))
-    return waveforms, cluster_map
+    return np.ascontiguousarray(waveforms.transpose(0, 2, 1)), cluster_map
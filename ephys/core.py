@@ -12,6 +12,33 @@ try:
 except ImportError:
     import json
 
+try:
+    from functools import lru_cache
+except ImportError:
+    def lru_cache(maxsize=128):
+        '''
+        Minimal stand-in for functools.lru_cache on python 2. Memoizes on
+            positional arguments and empties the cache once it holds maxsize
+            entries.
+        '''
+        def decorator(func):
+            cache = {}
+
+            @wraps(func)
+            def decorated(*args):
+                try:
+                    return cache[args]
+                except KeyError:
+                    pass
+                if len(cache) >= maxsize:
+                    cache.clear()
+                result = cache[args] = func(*args)
+                return result
+
+            return decorated
+
+        return decorator
+
 
 def file_finder(find_file_func):
     '''
@@ -123,6 +150,38 @@ def find_info(block_path):
     return os.path.join(block_path, '*_info.json')
 
 
+# chunk cache settings for hdf5 files that are read with many small selections
+H5_RDCC_NBYTES = 128 * 1024 * 1024
+H5_RDCC_NSLOTS = 1000003
+H5_RDCC_W0 = 0.75
+
+
+def open_h5(path, mode='r'):
+    '''
+    Opens a kwik, kwx or kwd file with an enlarged hdf5 chunk cache
+
+    Spike window and feature reads repeatedly hit the same chunks, which the
+    default 1 MiB cache evicts before they can be reused.
+
+    Parameters
+    ------
+    path : str
+        path to the hdf5 file
+    mode : str, optional
+        file mode (default: 'r')
+
+    Returns
+    ------
+    f : h5py File
+    '''
+    return h5.File(path, mode,
+                   rdcc_nbytes=H5_RDCC_NBYTES,
+                   rdcc_nslots=H5_RDCC_NSLOTS,
+                   rdcc_w0=H5_RDCC_W0,
+                   )
+
+
+@lru_cache(maxsize=32)
 def load_probe(block_path):
     '''
     Returns the probe info for the block
@@ -136,7 +195,10 @@ def load_probe(block_path):
     ------
     probe_info : dictionary of probe channels, geometry, and adjacencies
     '''
-    return imp.load_source('prb', find_prb(block_path))
+    prb_file = find_prb(block_path)
+    # load each probe file as its own module so that loading another block's
+    # probe does not overwrite a cached one
+    return imp.load_source('prb:{}'.format(prb_file), prb_file)
 
 
 def load_events(block_path, event_type):
@@ -184,6 +246,7 @@ def load_events(block_path, event_type):
     return pd.DataFrame(events)
 
 
+@lru_cache(maxsize=32)
 def load_fs(block_path):
     '''
     Reads sampling rate in Hz from the kwik file associated with a block
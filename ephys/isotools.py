@@ -5,11 +5,13 @@ import subprocess
 import tempfile
 import shutil
 import numpy as np
-import h5py as h5
 import pandas as pd
-from .core import load_clusters, load_spikes, find_kwx
+from .core import load_clusters, load_spikes, find_kwx, open_h5
 from six.moves import range
 
+# number of feature rows read from the kwx file at once
+ISOTOOLS_READ_ROWS = 100000
+
 
 def make_isotools_features(block_path, features_file, do_noise=False):
     '''
@@ -38,24 +40,32 @@ def make_isotools_features(block_path, features_file, do_noise=False):
         neurons = clusters[clusters.quality != 'Noise'].sort_values(['quality', 'cluster']).reset_index()
 
     spikes = load_spikes(block_path)
-    spike_index = np.where(spikes.cluster.isin(neurons.cluster).values == True)[0]
+    spike_mask = spikes.cluster.isin(neurons.cluster).values
 
-    clu_vals = np.unique(spikes.loc[spike_index].cluster.values)
-    lookup = {clu: idx + 1 for idx, clu in enumerate(clu_vals)}
+    clu_vals = np.unique(spikes.cluster.values[spike_mask])
 
     kwx = find_kwx(block_path)
-    with h5.File(kwx, 'r') as kf, open(features_file, 'w') as f:
+    with open_h5(kwx) as kf, open(features_file, 'w') as f:
 
-        n_features = kf['channel_groups/0/features_masks'].shape[1]
+        features_masks = kf['channel_groups/0/features_masks']
+        n_spikes, n_features = features_masks.shape[:2]
 
-        assert spikes.cluster.values.shape[0] == kf['channel_groups/0/features_masks'].shape[0]
+        assert spikes.cluster.values.shape[0] == n_spikes
 
         f.write(' '.join(['cluster_identifier'] + ['feature_' + str(ii) for ii in range(n_features)]) + '\n')
 
-        for indx in spike_index:
-            feat = kf['channel_groups/0/features_masks'][indx, :, 0]
-            cl = spikes.loc[indx]['cluster']
-            f.write(' '.join([str(lookup[cl])] + [str(ii) for ii in feat]) + '\n')
+        # clu_vals is sorted, so searchsorted gives the 1-based cluster identifier
+        spike_ids = np.searchsorted(clu_vals, spikes.cluster.values) + 1
+        fmt = ['%d'] + ['%.9g'] * n_features
+
+        # read contiguous blocks of rows and filter them in memory, rather
+        # than issuing one hdf5 selection per spike
+        for start in range(0, n_spikes, ISOTOOLS_READ_ROWS):
+            stop = start + ISOTOOLS_READ_ROWS
+            block_mask = spike_mask[start:stop]
+            features = features_masks[start:stop, :, 0][block_mask]
+            ids = spike_ids[start:stop][block_mask]
+            np.savetxt(f, np.column_stack([ids, features]), fmt=fmt, delimiter=' ')
 
     return clu_vals
 
@@ -1,13 +1,25 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import os, tqdm
-from ephys.spiketrains import get_spiketrain
+import math
+from ephys.spiketrains import get_spiketrain, get_spiketrains, get_cluster_times
 from ephys import core
 from ephys import events
 import numpy as np
 import scipy.stats as stats
+import scipy.signal as signal
 import matplotlib.pyplot as plt
-from six.moves import zip
+from six.moves import zip, range
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# maximum size of the (spikes x times) temporary built by gaussian_psth_func
+PSTH_BLOCK_ELEMENTS = 4 * 1024 * 1024
+# gaussians are truncated this many standard deviations from each spike
+PSTH_TRUNCATE_SIGMAS = 5.0
 
 
 def do_raster(raster_data, times, ticks, ntrials, ax=None, spike_linewidth=1.5,
@@ -40,15 +52,21 @@ def do_raster(raster_data, times, ticks, ntrials, ax=None, spike_linewidth=1.5,
     raster_plot :
         Handle to the raster plot
     '''
-    raster_data = np.array(raster_data)
     if ax is None:
         ax = plt.gca()
     ax.set_xlim(times)
     ax.set_ylim((-0.5, ntrials-0.5))
     ax.set_yticks(range(0, ntrials))
-    ax.eventplot(raster_data, linewidths=spike_linewidth, colors=spike_color)
-    for pltticks in ticks:
-        ax.axvline(pltticks, color=tick_color)
+
+    # one vertical line per spike, centered on its row, all in one artist
+    counts = [len(row) for row in raster_data]
+    spike_times = np.concatenate([np.empty(0)] + [np.asarray(row, dtype=float) for row in raster_data])
+    rows = np.repeat(np.arange(len(counts), dtype=float), counts)
+    ax.vlines(spike_times, rows - 0.5, rows + 0.5, colors=spike_color, linewidths=spike_linewidth)
+
+    # event ticks span the whole height of the axes
+    ax.vlines(ticks, 0, 1, transform=ax.get_xaxis_transform(),
+              colors=tick_color, linewidths=tick_linewidth)
     return ax
 
 
@@ -62,18 +80,17 @@ def plot_raster_stim_trial(spikes, trials, clusters, stim, trial, period,
     ntrials = len(stim_trials)
     stim_starts = stim_trials['time_samples'].values
     stim_ends = stim_trials['stimulus_end'].values
-    stim_end_seconds = np.unique((stim_ends - stim_starts)/fs)[0]
+    stim_end_seconds = np.min(stim_ends - stim_starts)/fs
     window = [period[0], stim_end_seconds+period[1]]
-    raster_data = []
     assert (trial < ntrials)
     start = stim_starts[trial]
-    for cell in clusters['cluster'].values:
-        sptrain = get_spiketrain(rec, start, cell, spikes, window, fs)
-        raster_data.append(sptrain)
-    do_raster(raster_data, window, [0, stim_end_seconds], ax, **kwargs)
+    raster_data = [get_spiketrain(rec, start, cell, spikes, window, fs)
+                   for cell in clusters['cluster'].values]
+    do_raster(raster_data, window, [0, stim_end_seconds], len(raster_data), ax, **kwargs)
 
 def plot_raster_cell_stim(spikes, trials, clusterID,
-                          stim, period, rec, fs, ax=None, stim_ref='stim', **kwargs):
+                          stim, period, rec, fs, ax=None, stim_ref='stim', stim_trials=None,
+                          cluster_times=None, **kwargs):
     '''
     Plots a spike raster for a single cell and stimulus
 
@@ -102,22 +119,28 @@ def plot_raster_cell_stim(spikes, trials, clusterID,
         'tick_color' - color of event ticks
     ax : Matplotlib axes handle, optional
         Axes on which to produce the raster.  Default is to use gca
+    stim_trials : pandas dataframe, optional
+        the rows of trials for stim, if already selected. Default is to
+        select them from trials
+    cluster_times : dict, optional
+        spike times grouped by spiketrains.get_cluster_times, to avoid
+        filtering spikes again when plotting many rasters
     kwargs :
         keyword arguments are passed to the do_raster method
     '''
-    stim_trials = trials[trials['stimulus'] == stim]
+    if stim_trials is None:
+        stim_trials = trials[trials['stimulus'] == stim]
     ntrials = len(stim_trials)
     stim_starts = stim_trials['time_samples'].values
     stim_ends = stim_trials['stimulus_end'].values
-    stim_end_seconds = np.unique((stim_ends - stim_starts) / fs)[0]
+    stim_end_seconds = np.min(stim_ends - stim_starts) / fs
     if stim_ref == 'stim':
         window = [period[0], stim_end_seconds + period[1]]
     elif stim_ref == 'abs':
         window = [period[0], period[1]]
-    raster_data = []
-    for trial, start in enumerate(stim_starts):
-        sptrain = get_spiketrain(rec, start, clusterID, spikes, window, fs)
-        raster_data.append(sptrain)
+
+    raster_data = get_spiketrains(rec, stim_starts, clusterID, spikes, window, fs,
+                                  cluster_times=cluster_times)
     ax = do_raster(raster_data, window, [0, stim_end_seconds], ntrials, ax, **kwargs)
     return ax
 
@@ -129,15 +152,18 @@ def plot_all_rasters(block_path):
     spikes = core.load_spikes(block_path)
     trials = events.oe_load_trials(block_path)
     fs = core.load_fs(block_path)
-    stims = np.unique(trials['stimulus'].values)
+    # split the trials by stimulus once for every cluster
+    stim_groups = list(trials.groupby('stimulus', observed=True))
     clusters = core.load_clusters(block_path)
+    cluster_times = get_cluster_times(spikes)
 
     os.makedirs(rasters_folder, exist_ok=True)
     for cluster in tqdm.tqdm(clusters["cluster"]):
         os.makedirs(os.path.join(rasters_folder, '{}/'.format(cluster)), exist_ok=True)
-        for stim in tqdm.tqdm(stims):
+        for stim, stim_trials in tqdm.tqdm(stim_groups):
             fig = plt.figure()
-            ax = plot_raster_cell_stim(spikes, trials, cluster, stim, [-2, 2], 0, fs)
+            ax = plot_raster_cell_stim(spikes, trials, cluster, stim, [-2, 2], 0, fs,
+                                       stim_trials=stim_trials, cluster_times=cluster_times)
             ax.set_xlabel('Time (s)')
             ax.set_ylabel('Trial Number')
             ax.set_title('Unit: {}  Stimulus: {}'.format(cluster, stim))
@@ -183,15 +209,11 @@ def plot_raster_cell_stim_emily(spikes, trials, clusterID,
     ntrials = len(stim_trials)
     stim_starts = stim_trials['time_samples'].values
     stim_ends = stim_trials['stimulus_end'].values
-    stim_end_seconds = np.unique((stim_ends - stim_starts) / fs)[0]
+    stim_end_seconds = np.min(stim_ends - stim_starts) / fs
     window = [period[0], stim_end_seconds + period[1]]
-    raster_data = []
-    for trial, stpl in enumerate(zip(stim_starts, stim_recs)):
-        start = stpl[0]
-        srec = stpl[1]
-        sptrain = get_spiketrain(srec, start, clusterID, spikes, window, fs)
-        raster_data.append(sptrain)
-    do_raster(raster_data, window, [0, stim_end_seconds], ax, **kwargs)
+    raster_data = [get_spiketrain(srec, start, clusterID, spikes, window, fs)
+                   for start, srec in zip(stim_starts, stim_recs)]
+    do_raster(raster_data, window, [0, stim_end_seconds], len(raster_data), ax, **kwargs)
 
 
 def plot_raster_stim_trial(spikes, trials, clusters, 
@@ -205,16 +227,13 @@ def plot_raster_stim_trial(spikes, trials, clusters,
     this_trial = stim_trials.iloc[trial]
     stim_start = this_trial['time_samples']
     stim_end = this_trial['stimulus_end']
-    stim_end_seconds = np.unique((stim_end - stim_start)/fs)[0]
+    stim_end_seconds = (stim_end - stim_start)/fs
     window = [period[0], stim_end_seconds+period[1]]
-    raster_data = []
-    for clu_num, clu in enumerate(cluIDs):
-        sptrain = get_spiketrain(rec, stim_start, clu, spikes, window, fs)
-        raster_data.append(sptrain)
+    raster_data = [get_spiketrain(rec, stim_start, clu, spikes, window, fs) for clu in cluIDs]
     if plot_params == None:
-        do_raster(raster_data, window, [0, stim_end_seconds], ax) 
+        do_raster(raster_data, window, [0, stim_end_seconds], len(raster_data), ax) 
     else:
-        do_raster(raster_data, window, [0, stim_end_seconds], ax, 
+        do_raster(raster_data, window, [0, stim_end_seconds], len(raster_data), ax,
                   spike_linewidth=plot_params['spike_linewidth'],
                   spike_color=plot_params['spike_color'],
                   tick_linewidth=plot_params['tick_linewidth'],
@@ -222,31 +241,84 @@ def plot_raster_stim_trial(spikes, trials, clusters,
 
 
 
-def gaussian_psth_func(times, spike_data, sigma):
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _gaussian_psth_numba(times, spike_data, lo, hi, inv2s2, out):
+        '''
+        Accumulates the gaussian of each spike into out without temporaries.
+        Parallel over times so that each output element has a single writer;
+        time i only visits the sorted spikes lo[i]:hi[i].
+        '''
+        for i in prange(times.shape[0]):
+            acc = 0.0
+            for j in range(lo[i], hi[i]):
+                d = times[i] - spike_data[j]
+                acc += math.exp(-d * d * inv2s2)
+            out[i] += acc
+else:
+    _gaussian_psth_numba = None
+
+
+def gaussian_psth_func(times, spike_data, sigma, out=None):
     '''
     Generates a gaussian psth from spike data
 
+    Each gaussian is truncated PSTH_TRUNCATE_SIGMAS standard deviations
+    from its spike.
+
     Parameters
     ------
     times : numpy array
-        times to generate psth for
+        ascending times to generate psth for
     spike_data : list of floats
         times of each spike
     sigma : float
         standard deviation of the gaussian
+    out : numpy array, optional
+        preallocated float64 array (e.g. a row of a trials x times matrix)
+        that is overwritten with the psth
 
     Return
     ------
     output : numpy array
         gaussian peristimulus time histogram
     '''
-    output = np.zeros(len(times))
-    for spike_time in spike_data:
-        output = output + np.exp(-1.0 * np.square(times - spike_time) / (2 * sigma ** 2))
+    times = np.asarray(times, dtype=np.float64)
+    spike_data = np.sort(np.asarray(spike_data, dtype=np.float64))
+    if out is None:
+        output = np.zeros(len(times))
+    else:
+        output = out
+        output[:] = 0
+    inv2s2 = 0.5 / sigma ** 2
+    half_width = PSTH_TRUNCATE_SIGMAS * sigma
+    if _gaussian_psth_numba is not None:
+        lo = np.searchsorted(spike_data, times - half_width, side='left')
+        hi = np.searchsorted(spike_data, times + half_width, side='right')
+        _gaussian_psth_numba(times, spike_data, lo, hi, inv2s2, output)
+        return output
+    # each spike only touches the times within half_width of it
+    i0 = np.searchsorted(times, spike_data - half_width, side='left')
+    i1 = np.searchsorted(times, spike_data + half_width, side='right')
+    span = int((i1 - i0).max()) if len(spike_data) else 0
+    if span == 0:
+        return output
+    # evaluate blocks of spikes at once to bound the (spikes x span) temporary
+    block_size = max(1, PSTH_BLOCK_ELEMENTS // span)
+    offsets = np.arange(span)
+    for i in range(0, len(spike_data), block_size):
+        idx = i0[i:i + block_size, np.newaxis] + offsets
+        valid = idx < i1[i:i + block_size, np.newaxis]
+        idx = idx[valid]
+        diffs = (times[idx] -
+                 np.broadcast_to(spike_data[i:i + block_size, np.newaxis], valid.shape)[valid])
+        output += np.bincount(idx, weights=np.exp(-inv2s2 * diffs * diffs),
+                              minlength=len(times))
     return output
 
 
-def calc_avg_gaussian_psth(spikes, trials, clusterID, stim, period, rec, fs, sigma=0.05, alpha=0.95):
+def calc_avg_gaussian_psth(spikes, trials, clusterID, stim, period, rec, fs, sigma=0.05, alpha=0.95,
+                           stim_trials=None, cluster_times=None):
     '''
     Calculates a gaussian smoothed average psth over all trials of stim for a given cluster.
 
@@ -271,6 +343,10 @@ def calc_avg_gaussian_psth(spikes, trials, clusterID, stim, period, rec, fs, sig
         stand deviation for gaussian
     alpha : float
         confidence level
+    stim_trials : pandas dataframe, optional
+        the rows of trials for stim, if already selected
+    cluster_times : dict, optional
+        spike times grouped by spiketrains.get_cluster_times
 
     Returns
     ------
@@ -284,19 +360,34 @@ def calc_avg_gaussian_psth(spikes, trials, clusterID, stim, period, rec, fs, sig
         times for the signals
     '''
 
-    stim_trials = trials[trials['stimulus'] == stim]
+    if stim_trials is None:
+        stim_trials = trials[trials['stimulus'] == stim]
     ntrials = len(stim_trials)
     stim_starts = stim_trials['time_samples'].values
     stim_ends = stim_trials['stimulus_end'].values
 
-    stim_end_seconds = np.unique((stim_ends - stim_starts) / fs)[0]
+    stim_end_seconds = np.min(stim_ends - stim_starts) / fs
     window = [period[0], stim_end_seconds + period[1]]
-    npts = np.floor(1.0 * (window[1] - window[0]) * fs)
-    times = np.linspace(window[0], window[1], npts)
-    psths = np.zeros((ntrials, npts))
-    for trial, start in enumerate(stim_starts):
-        sptrain = get_spiketrain(rec, start, clusterID, spikes, window, fs)
-        psths[trial, :] = gaussian_psth_func(times, sptrain, sigma)
+    # one point per sample, so the grid step is exactly 1/fs
+    npts = int(round((window[1] - window[0]) * fs))
+    times = window[0] + np.arange(npts) / fs
+    dt = 1.0 / fs
+
+    # bin the spikes of all trials onto the time grid in one flat pass ...
+    sptrains = get_spiketrains(rec, stim_starts, clusterID, spikes, window, fs,
+                               cluster_times=cluster_times)
+    flat = np.concatenate([np.empty(0)] + sptrains)
+    trial_idx = np.repeat(np.arange(ntrials), [len(sptrain) for sptrain in sptrains])
+    idx = np.round((flat - window[0]) / dt).astype(int)
+    valid = (idx >= 0) & (idx < npts)
+    psths = np.bincount(trial_idx[valid] * npts + idx[valid],
+                        minlength=ntrials * npts).reshape(ntrials, npts).astype(np.float64)
+
+    # ... then smooth all trials with a single convolution
+    half_width = int(np.ceil(PSTH_TRUNCATE_SIGMAS * sigma / dt))
+    kernel_times = np.arange(-half_width, half_width + 1) * dt
+    gauss_kernel = np.exp(-0.5 * np.square(kernel_times / sigma))
+    psths = signal.fftconvolve(psths, gauss_kernel[np.newaxis, :], mode='same', axes=1)
     avg_psth = np.mean(psths, 0)
     std_psth = np.std(psths, 0)
     conf_ints = stats.t.interval(alpha, df=ntrials - 1, loc=avg_psth, scale=std_psth / np.sqrt(ntrials))
@@ -336,13 +427,15 @@ def plot_unit_raster(spikes, trials, clusterID, raster_window, rec, fs, subplot_
         matplotlib Figure
     '''
 
-    stims = trials['stimulus'].unique()
-
     f, pltaxes = plt.subplots(subplot_xy[0], subplot_xy[1], sharey=True, figsize=figsize)
-    for ind, stim in enumerate(stims):
-        ax = pltaxes.flatten()[ind]
+    axes = pltaxes.flatten()
+    cluster_times = get_cluster_times(spikes[spikes['cluster'] == clusterID])
+    # a single pass over trials, with stimuli in order of first appearance
+    for ind, (stim, stim_trials) in enumerate(trials.groupby('stimulus', sort=False, observed=True)):
+        ax = axes[ind]
         plot_raster_cell_stim(spikes, trials, clusterID, stim,
-                              raster_window, rec, fs, ax=ax, **kwargs)
+                              raster_window, rec, fs, ax=ax, stim_trials=stim_trials,
+                              cluster_times=cluster_times, **kwargs)
         ax.set_title('Unit: {} Stim: {}'.format(str(clusterID), stim))
         ax.set_xlabel('Time (seconds)')
         ax.set_ylabel('Repetition')
@@ -386,6 +479,9 @@ def plot_unit_raster_emily(spikes, trials, clusterID, raster_window, rec, fs, su
 
     stims = np.unique(trials['stimulus'].values)
     # stims = stims[~np.isnan(stims)]
+    # the trials are filtered by stimulus repeatedly below; comparing
+    # category codes is cheaper than comparing strings
+    trials = trials.assign(stimulus=trials['stimulus'].astype('category'))
 
     f, pltaxes = plt.subplots(subplot_xy[0], subplot_xy[1], sharey=True, figsize=figsize)
     for ind, stim in enumerate(stims):
@@ -446,11 +542,9 @@ def plot_trial_raster_emily(spikes, trials, clusters, trialID, stim, period, rec
 
     clusterIDs = clusters['cluster'].values
     window = [period[0], stim_end_seconds + period[1]]
-    raster_data = []
-    for cluster in clusterIDs:
-        sptrain = get_spiketrain(srec, stim_start, cluster, spikes, window, fs)
-        raster_data.append(sptrain)
-    do_raster(raster_data, window, [0, stim_end_seconds], ax, **kwargs)
+    raster_data = [get_spiketrain(srec, stim_start, cluster, spikes, window, fs)
+                   for cluster in clusterIDs]
+    do_raster(raster_data, window, [0, stim_end_seconds], len(raster_data), ax, **kwargs)
 
 
 def plot_avg_gaussian_psth_cell_stim(spikes, trials, clusterID, stim, raster_window, rec, fs, ax=None):
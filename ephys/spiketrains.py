@@ -40,7 +40,68 @@ def get_spiketrain(rec, samps, clu, spikes, window, fs):
             (perievent_spikes['recording'] == rec)
             & (perievent_spikes['cluster'] == clu)
     )
-    return (perievent_spikes['time_samples'][mask].values.astype(np.float_) - samps) / fs
+    return (perievent_spikes['time_samples'][mask].values.astype(np.float64) - samps) / fs
+
+
+def get_cluster_times(spikes):
+    '''
+    Groups spike times by recording and cluster in a single pass
+
+    Parameters
+    ------
+    spikes : pandas dataframe
+        the pandas dataframe containing spikes (see core)
+
+    Returns
+    ------
+    cluster_times : dict
+        sorted spike times in samples (float64) keyed by (recording, cluster)
+    '''
+    cluster_times = {}
+    for key, times in spikes.groupby(['recording', 'cluster'], sort=False)['time_samples']:
+        cluster_times[key] = np.sort(times.values).astype(np.float64)
+    return cluster_times
+
+
+def get_spiketrains(rec, samps, clu, spikes, window, fs, cluster_times=None):
+    '''
+    Returns a list of spike trains for a single cluster, one per sampling
+        time, using the same bounds as get_spiketrain.
+
+    The cluster's spikes are selected and sorted once and every window is
+    located with a single searchsorted call.
+
+    Parameters
+    ------
+    rec : int
+        the recording to look in
+    samps : array-like of ints
+        the times to lock the spiketrains to in samples
+    clu : int
+        the cluster identifier to get spikes from
+    spikes : pandas dataframe
+        the pandas dataframe containing spikes (see core)
+    window : tuple or list of floats
+        the window around each event in seconds to sample spikes
+    fs : float
+        sampling rate of the recording
+    cluster_times : dict, optional
+        output of get_cluster_times for spikes. When given, the cluster's
+        times are looked up instead of filtered out of spikes
+
+    Returns
+    ------
+    spike_trains : list of numpy arrays of spike times in seconds
+    '''
+    samps = np.asarray(samps)
+    if cluster_times is None:
+        mask = (spikes['recording'] == rec) & (spikes['cluster'] == clu)
+        clu_times = np.sort(spikes['time_samples'][mask].values).astype(np.float64)
+    else:
+        clu_times = cluster_times.get((rec, clu), np.empty(0))
+    lo = np.searchsorted(clu_times, samps + window[0] * fs, side='right')
+    hi = np.searchsorted(clu_times, samps + window[1] * fs, side='right')
+    return [(clu_times[l:h] - samp) / fs for l, h, samp in zip(lo, hi, samps)]
 
 
 def calc_spikes_in_window(spikes, window):
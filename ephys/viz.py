@@ -1,14 +1,23 @@
 from __future__ import absolute_import
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
 import seaborn as sns
 from .core import load_probe, load_fs, load_clusters
-from .clust import get_mean_waveform_array, upsample_spike, find_mean_masks
+from .clust import get_mean_waveform_array, upsample_spike
 from .clust import get_cluster_coords, mean_masks_w, get_spike_exemplar
 from six.moves import zip
 
 
-def plot_cluster(block_path, cluster, chan_alpha=None, scale_factor=0.05, color='0.5', **plot_kwargs):
+def _probe_coords(prb_info):
+    channels = prb_info.channel_groups[0]['channels']
+    geometry = prb_info.channel_groups[0]['geometry']
+    return np.array([geometry[ch] for ch in channels])
+
+
+def plot_cluster(block_path, cluster, chan_alpha=None, scale_factor=0.05, color='0.5',
+                 prb_info=None, coords=None, **plot_kwargs):
     '''
     Plots the mean waveforms on each channel for a single cluster, in the 
         geometric layout from the probe file. 
@@ -25,34 +34,36 @@ def plot_cluster(block_path, cluster, chan_alpha=None, scale_factor=0.05, color=
         the factor to scale the waveforms (default: 0.05)
     color
         color to plot (default: '0.5')
+    prb_info : probe info, optional
+        probe info from load_probe. default: load it from block_path
+    coords : numpy array, optional
+        probe coordinates of each channel. default: read from prb_info
     kwargs
-        keyword arguments are passed to the plot function
+        keyword arguments are passed to the LineCollection
     
     '''
 
     # load the probe coordinates
-    prb_info = load_probe(block_path)
-    channels = prb_info.channel_groups[0]['channels']
-    geometry = prb_info.channel_groups[0]['geometry']
-    coords = np.array([geometry[ch] for ch in channels])
+    if prb_info is None:
+        prb_info = load_probe(block_path)
+    if coords is None:
+        coords = _probe_coords(prb_info)
 
     if chan_alpha is None:
         chan_alpha = np.ones(len(coords))
 
-    mean_waveform_array = get_mean_waveform_array(block_path, cluster)
+    mean_waveform_array = get_mean_waveform_array(block_path, cluster, prb_info=prb_info)
+
+    # all channels are drawn as one collection, with per-channel alpha
+    nsamp, nchan = mean_waveform_array.shape
+    xs = coords[:, 0, np.newaxis] + np.arange(nsamp) - nsamp / 2
+    ys = mean_waveform_array.T * scale_factor + coords[:, 1, np.newaxis]
+    colors = np.tile(to_rgba(color), (nchan, 1))
+    colors[:, 3] = np.clip(chan_alpha, 0.0, 1.0)
 
-    for waveform, xy, alpha in zip(mean_waveform_array.T, coords, chan_alpha):
-        plt.plot(xy[0] + np.arange(len(waveform)) - len(waveform) / 2,
-                 waveform * scale_factor + xy[1],
-                 color=color,
-                 alpha=alpha,
-                 **plot_kwargs
-                 )
-        try:
-            # if we get a label, let's only apply it once
-            label = plot_kwargs.pop('label')
-        except KeyError:
-            pass
+    ax = plt.gca()
+    ax.add_collection(LineCollection(np.stack([xs, ys], axis=-1), colors=colors, **plot_kwargs))
+    ax.autoscale_view()
 
 
 def plot_all_clusters(block_path, clusters=None, quality=('Good', 'MUA'), **kwargs):
@@ -85,19 +96,24 @@ def plot_all_clusters(block_path, clusters=None, quality=('Good', 'MUA'), **kwar
 
     palette = sns.color_palette("hls", len(clusters))
 
-    for idx, cluster_row in clusters.iterrows():
-        lbl = "{}({})".format(cluster_row.cluster, cluster_row.quality)
+    # the probe layout is shared by every cluster
+    prb_info = load_probe(block_path)
+    coords = _probe_coords(prb_info)
+
+    cluster_ids = clusters['cluster'].values
+    qualities = clusters['quality'].values
+    for idx, (cluster, cluster_quality) in enumerate(zip(cluster_ids, qualities)):
+        lbl = "{}({})".format(cluster, cluster_quality)
 
         # use mean mask for alpha transparency
-        mean_masks_array = np.fromfile(
-            find_mean_masks(block_path, cluster_row.cluster),
-            dtype=np.float32
-        )
+        mean_masks_array = mean_masks_w(block_path, cluster)
 
         plot_cluster(block_path,
-                     cluster_row.cluster,
+                     cluster,
                      color=palette[idx],
                      chan_alpha=mean_masks_array,
+                     prb_info=prb_info,
+                     coords=coords,
                      label=lbl,
                      **kwargs
                      )
@@ -161,15 +177,13 @@ def plot_cluster_locations(block_path, clusters=None, quality=('Good', 'MUA'), b
         clusters = load_clusters(block_path)
         clusters = clusters[clusters.quality.isin(quality)]
 
-    if 'x_probe' not in clusters.columns:
-        clusters['x_probe'] = clusters['cluster'].map(
-            lambda clu: get_cluster_coords(block_path, clu, weight_func=mean_masks_w)[0]
-        )
-
-    if 'y_probe' not in clusters.columns:
-        clusters['y_probe'] = clusters['cluster'].map(
-            lambda clu: get_cluster_coords(block_path, clu, weight_func=mean_masks_w)[1]
-        )
+    if 'x_probe' not in clusters.columns or 'y_probe' not in clusters.columns:
+        xy = np.array([get_cluster_coords(block_path, clu, weight_func=mean_masks_w)
+                       for clu in clusters['cluster'].values]).reshape(-1, 2)
+        if 'x_probe' not in clusters.columns:
+            clusters['x_probe'] = xy[:, 0]
+        if 'y_probe' not in clusters.columns:
+            clusters['y_probe'] = xy[:, 1]
 
     prb_info = load_probe(block_path)
     coords = np.array(list(prb_info.channel_groups[0]['geometry'].values()))
@@ -212,10 +226,11 @@ def plot_mean_cluster_waveforms(waveforms, cluster_map, figsize=(15, 15), sharey
     num_clusters = len(cluster_map)
     nrows = int(np.sqrt(num_clusters))
     ncols = int(np.ceil(float(num_clusters) / nrows))
-    inverted_cluster_map = {cluster_map[k]: k for k in cluster_map}
+    titles = [None] * num_clusters
+    for clu, i in cluster_map.items():
+        titles[i] = clu
     fig, axs = plt.subplots(nrows=nrows, ncols=ncols, figsize=figsize, sharex=True, sharey=sharey)
-    for i, ax in enumerate(axs.reshape(-1)):
-        if i < num_clusters:
-            ax.plot(waveforms[i, :, :])
-            ax.set_title(inverted_cluster_map[i])
+    for ax, waveform, title in zip(np.asarray(axs).flat, waveforms, titles):
+        ax.plot(waveform)
+        ax.set_title(title)
     sns.despine(fig=fig, left=True, bottom=True, trim=True)
\ No newline at end of file
@@ -0,0 +1,165 @@
+import unittest
+import tempfile
+import shutil
+import os
+import json
+import numpy as np
+import pandas as pd
+import h5py as h5
+from ephys import clust
+
+
+class ClustTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._block_path = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        cls._data = {rec: rng.randint(-500, 500, size=(5000, 4)).astype(np.int16)
+                     for rec in (0, 1)}
+        with h5.File(os.path.join(cls._block_path, 'test.raw.kwd'), 'w') as kwd_f:
+            for rec, data in cls._data.items():
+                kwd_f.create_dataset('recordings/{}/data'.format(rec), data=data)
+        nspikes = 300
+        cls._spikes = pd.DataFrame(dict(
+            cluster=rng.choice([3, 7, 12], nspikes),
+            recording=rng.randint(0, 2, nspikes),
+            time_samples=rng.randint(0, 5000, nspikes),
+        ))
+
+        cls._fs = 30000.0
+        with h5.File(os.path.join(cls._block_path, 'test.kwik'), 'w') as kwik_f:
+            kwik_f.create_group('recordings/0').attrs['sample_rate'] = cls._fs
+            kwik_f['channel_groups/0/spikes/clusters/main'] = cls._spikes.cluster.values
+        cls._geometry = {0: (0.0, 0.0), 1: (0.0, 50.0), 2: (20.0, 25.0), 3: (20.0, 75.0)}
+        with open(os.path.join(cls._block_path, 'test.prb'), 'w') as prb_f:
+            prb_f.write('channel_groups = {0: {"channels": [0, 1, 2, 3], '
+                        '"geometry": %r}}\n' % cls._geometry)
+
+        # gaussian-derivative spike shapes of increasing width on channel 2
+        phy_fold = os.path.join(cls._block_path, 'test.phy', 'cluster_store', '0', 'main')
+        os.makedirs(phy_fold)
+        t = np.arange(41) - 15.0
+        cls._exemplars = {}
+        cls._mean_masks = {}
+        for cluster, scale in ((3, 1.5), (7, 3.0), (12, 4.5)):
+            exemplar = (-np.exp(-0.5 * (t / scale) ** 2)
+                        + 0.4 * np.exp(-0.5 * ((t - 3 * scale) / (2 * scale)) ** 2))
+            mean_waveforms = 0.1 * rng.randn(41, 4)
+            mean_waveforms[:, 2] = exemplar
+            mean_waveforms.astype(np.float32).tofile(
+                os.path.join(phy_fold, '{}.mean_waveforms'.format(cluster)))
+            mean_masks = np.array([0.1, 0.3, 0.9, 0.2], dtype=np.float32)
+            mean_masks.tofile(os.path.join(phy_fold, '{}.mean_masks'.format(cluster)))
+            cls._exemplars[cluster] = exemplar.astype(np.float32)
+            cls._mean_masks[cluster] = mean_masks
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._block_path)
+
+    def test_compute_cluster_waveforms_fast(self):
+        before, after = 10, 30
+        waveforms, cluster_map = clust.compute_cluster_waveforms_fast(
+            self._block_path, self._spikes, before=before, after=after)
+        assert sorted(cluster_map) == [3, 7, 12]
+        assert waveforms.shape == (3, before + 1 + after, 4)
+        for cluster, idx in cluster_map.items():
+            windows = []
+            for _, spike in self._spikes[self._spikes.cluster == cluster].iterrows():
+                start = spike.time_samples - before
+                data = self._data[spike.recording]
+                if start > 0 and start + before + 1 + after < data.shape[0]:
+                    windows.append(data[start:start + before + 1 + after])
+            assert np.allclose(waveforms[idx], np.mean(windows, axis=0))
+
+    def test_compute_cluster_waveforms(self):
+        block_path = tempfile.mkdtemp()
+        try:
+            prespike, postspike = 10, 20
+            data = self._data[0]
+            spike_times = np.sort(self._spikes.time_samples.values[:100])
+            spike_times[0] = 3
+            clusters = self._spikes.cluster.values[:100]
+            with h5.File(os.path.join(block_path, 'test.kwik'), 'w') as kwik_f:
+                kwik_f['channel_groups/0/spikes/clusters/main'] = clusters
+                kwik_f['channel_groups/0/spikes/recording'] = np.zeros(100, dtype=int)
+                kwik_f['channel_groups/0/spikes/time_samples'] = spike_times
+            with h5.File(os.path.join(block_path, 'test.raw.kwd'), 'w') as kwd_f:
+                kwd_f['recordings/0/data'] = data
+            with h5.File(os.path.join(block_path, 'test.kwx'), 'w') as kwx_f:
+                kwx_f['channel_groups/0/features_masks'] = np.random.rand(100, 12, 2)
+            with open(os.path.join(block_path, 'test_info.json'), 'w') as info_f:
+                json.dump({'params': {'prespike': prespike, 'postspike': postspike, 'nchan': 4}}, info_f)
+
+            clust.compute_cluster_waveforms(block_path)
+
+            padded = np.concatenate([np.zeros((prespike, 4)), data, np.zeros((postspike, 4))])
+            phy_fold = clust.make_phy_folder(block_path)
+            for cluster in np.unique(clusters):
+                expected = np.array([padded[t:t + prespike + postspike]
+                                     for t in spike_times[clusters == cluster]])
+                waveforms = np.fromfile(os.path.join(phy_fold, '{}.waveforms'.format(cluster)))
+                mean_waveform = np.fromfile(os.path.join(phy_fold, '{}.mean_waveforms'.format(cluster)))
+                assert np.array_equal(waveforms, expected.flatten())
+                assert np.allclose(mean_waveform, expected.mean(axis=0).flatten())
+        finally:
+            shutil.rmtree(block_path)
+
+    def test_spikeindices_all(self):
+        indices = clust.spikeindices_all(self._block_path)
+        assert sorted(indices) == [3, 7, 12]
+        for cluster, cluster_indices in indices.items():
+            mask = clust.spikeindices(self._block_path, cluster)
+            assert np.array_equal(cluster_indices, np.flatnonzero(mask))
+
+    def test_get_cluster_coords(self):
+        for cluster in self._mean_masks:
+            xy = clust.get_cluster_coords(self._block_path, cluster)
+            assert np.array_equal(xy, self._geometry[2])
+            assert np.array_equal(xy, clust.get_cluster_coords(self._block_path, cluster,
+                                                               weight_func=clust.max_masks_w))
+
+    def test_get_troughpeak(self):
+        time = np.arange(41) / self._fs
+        shapes = np.array([self._exemplars[cluster] for cluster in (3, 7, 12)])
+        troughs, peaks = clust.get_troughpeak(time, shapes)
+        for shape, trough, peak in zip(shapes, troughs, peaks):
+            trough_i = shape.argmin()
+            assert trough == time[trough_i]
+            assert peak == time[shape[trough_i:].argmax() + trough_i]
+            assert clust.get_troughpeak(time, shape) == (trough, peak)
+
+    def test_get_width_half_height(self):
+        time = np.arange(-1000, 1001) * 1e-6
+        sigma = 1e-4
+        spike_shape = -np.exp(-0.5 * (time / sigma) ** 2)
+        original = spike_shape.copy()
+        width = clust.get_width_half_height(time, spike_shape)
+        assert np.isclose(width, 2 * sigma * np.sqrt(2 * np.log(2)), atol=2e-6), width
+        assert np.array_equal(spike_shape, original)
+        assert np.isnan(clust.get_width_half_height(time, spike_shape[:1000]))
+
+    def test_mean_masks_w(self):
+        for cluster, mean_masks in self._mean_masks.items():
+            w = clust.mean_masks_w(self._block_path, cluster)
+            assert np.array_equal(w, mean_masks)
+            # callers get their own copy of the cached array
+            w /= w.sum()
+            assert np.array_equal(clust.mean_masks_w(self._block_path, cluster), mean_masks)
+
+    def test_get_spike_exemplar(self):
+        for cluster, exemplar in self._exemplars.items():
+            assert np.array_equal(clust.get_spike_exemplar(self._block_path, cluster), exemplar)
+
+    def test_get_wide_narrow(self):
+        widths = [clust.get_width(self._block_path, cluster) for cluster in (3, 7, 12)]
+        assert widths[0] < widths[1] < widths[2]
+        wide, narrow = clust.get_wide_narrow(self._block_path, [3, 7, 12], widths[1])
+        assert wide == [7, 12]
+        assert narrow == [3]
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
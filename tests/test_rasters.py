@@ -0,0 +1,107 @@
+import unittest
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pandas as pd
+from ephys import rasters
+from ephys.spiketrains import get_spiketrain
+
+
+class RastersTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._fs = 1000.0
+        rng = np.random.RandomState(0)
+        cls._stim_starts = np.array([5000, 15000, 25000, 35000])
+        cls._spikes = pd.DataFrame(dict(
+            cluster=rng.randint(0, 2, 400),
+            recording=np.zeros(400, dtype=int),
+            time_samples=np.sort(rng.randint(0, 40000, 400)),
+        ))
+        cls._trials = pd.DataFrame(dict(
+            stimulus=['a', 'b', 'a', 'a'],
+            recording=np.zeros(4, dtype=int),
+            time_samples=cls._stim_starts,
+            stimulus_end=cls._stim_starts + 2000,
+        ))
+
+    def test_gaussian_psth_func(self):
+        times = np.linspace(-1.0, 2.0, 3001)
+        spike_data = np.array([-0.5, 0.0, 0.01, 1.2, 1.95])
+        sigma = 0.05
+        expected = np.zeros(len(times))
+        for spike_time in spike_data:
+            expected += np.exp(-1.0 * np.square(times - spike_time) / (2 * sigma ** 2))
+        output = rasters.gaussian_psth_func(times, spike_data, sigma)
+        # truncation at 5 sigma drops tails below exp(-12.5)
+        assert np.allclose(output, expected, atol=1e-5), np.abs(output - expected).max()
+        assert np.all(output[times < -0.5 - 5 * sigma] == 0)
+
+    def test_gaussian_psth_func_out(self):
+        times = np.linspace(0.0, 1.0, 101)
+        spike_data = np.array([0.2, 0.7])
+        psths = np.ones((2, len(times)))
+        output = rasters.gaussian_psth_func(times, spike_data, 0.05, out=psths[1])
+        assert np.shares_memory(output, psths)
+        assert np.allclose(psths[1], rasters.gaussian_psth_func(times, spike_data, 0.05))
+        assert np.all(psths[0] == 1)
+
+    def test_gaussian_psth_func_no_spikes(self):
+        times = np.linspace(0.0, 1.0, 101)
+        output = rasters.gaussian_psth_func(times, [], 0.05)
+        assert output.shape == times.shape
+        assert np.all(output == 0)
+
+    def test_do_raster(self):
+        fig, ax = plt.subplots()
+        raster_data = [[0.1, 0.5], [], [0.2, 0.3, 0.9]]
+        rasters.do_raster(raster_data, [0, 1], [0.0, 0.8], 3, ax=ax)
+        spike_collection, tick_collection = ax.collections
+        segs = spike_collection.get_segments()
+        assert len(segs) == 5
+        assert np.allclose(segs[2], [[0.2, 1.5], [0.2, 2.5]])
+        assert len(tick_collection.get_segments()) == 2
+        # ticks span the full height even when a shared y axis is taller
+        assert np.allclose(tick_collection.get_segments()[0], [[0.0, 0.0], [0.0, 1.0]])
+        assert tick_collection.get_transform() != ax.transData
+        plt.close(fig)
+
+    def test_calc_avg_gaussian_psth(self):
+        fs, stim_starts = self._fs, self._stim_starts
+        spikes, trials = self._spikes, self._trials
+        period = [-1.0, 1.0]
+        avg_psth, std_psth, conf_ints, times = rasters.calc_avg_gaussian_psth(
+            spikes, trials, 1, 'a', period, 0, fs)
+
+        window = [period[0], 2.0 + period[1]]
+        expected = np.array([
+            rasters.gaussian_psth_func(times, get_spiketrain(0, start, 1, spikes, window, fs), 0.05)
+            for start in stim_starts[[0, 2, 3]]
+        ])
+        assert np.allclose(avg_psth, expected.mean(axis=0), atol=1e-2)
+        assert np.allclose(std_psth, expected.std(axis=0), atol=1e-2)
+
+        grouped = rasters.calc_avg_gaussian_psth(
+            spikes, trials, 1, 'a', period, 0, fs,
+            stim_trials=trials[trials['stimulus'] == 'a'])
+        assert np.array_equal(grouped[0], avg_psth)
+
+    def test_plot_unit_raster_emily(self):
+        fs, stim_starts = self._fs, self._stim_starts
+        spikes, trials = self._spikes, self._trials
+        stim_dtype = trials['stimulus'].dtype
+        fig = rasters.plot_unit_raster_emily(spikes, trials, 1, [-1.0, 1.0], 0, fs, (1, 2), (4, 2))
+        assert trials['stimulus'].dtype == stim_dtype
+        for ax, stim in zip(fig.axes, ['a', 'b']):
+            starts = stim_starts[trials['stimulus'].values == stim]
+            nspikes = sum(len(get_spiketrain(0, start, 1, spikes, [-1.0, 3.0], fs)) for start in starts)
+            assert len(ax.collections[0].get_segments()) == nspikes
+            assert ax.get_title() == 'Unit: 1 Stim: {}'.format(stim)
+        plt.close(fig)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
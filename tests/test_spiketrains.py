@@ -0,0 +1,42 @@
+import unittest
+import numpy as np
+import pandas as pd
+from ephys import spiketrains
+
+
+class SpiketrainsTest(unittest.TestCase):
+
+    def test_get_spiketrains(self):
+        fs = 1000.0
+        rng = np.random.RandomState(0)
+        spikes = pd.DataFrame(dict(
+            cluster=rng.randint(0, 3, 500),
+            recording=rng.randint(0, 2, 500),
+            time_samples=rng.randint(0, 20000, 500),
+        ))
+        # include spikes exactly on the window bounds
+        samps = np.array([1000, 5000, 5000, 12000, 19500])
+        window = [-0.5, 1.0]
+        spikes.loc[0, ['cluster', 'recording', 'time_samples']] = [1, 0, 500]
+        spikes.loc[1, ['cluster', 'recording', 'time_samples']] = [1, 0, 2000]
+        trains = spiketrains.get_spiketrains(0, samps, 1, spikes, window, fs)
+        assert len(trains) == len(samps)
+        for samp, train in zip(samps, trains):
+            expected = spiketrains.get_spiketrain(0, samp, 1, spikes, window, fs)
+            assert np.array_equal(train, np.sort(expected))
+
+        cluster_times = spiketrains.get_cluster_times(spikes)
+        assert set(cluster_times) == set(zip(spikes['recording'], spikes['cluster']))
+        grouped = spiketrains.get_spiketrains(0, samps, 1, spikes, window, fs,
+                                              cluster_times=cluster_times)
+        for train, expected in zip(grouped, trains):
+            assert np.array_equal(train, expected)
+        missing = spiketrains.get_spiketrains(5, samps, 1, spikes, window, fs,
+                                              cluster_times=cluster_times)
+        assert all(len(train) == 0 for train in missing)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()